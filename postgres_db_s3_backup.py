@@ -1,28 +1,111 @@
 #!/usr/bin/env python3
 
 import subprocess
+import contextlib
 import os
+import shutil
+import tempfile
+import tarfile
+import stat
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import datetime
 import configparser
 import sys
+import concurrent.futures
 import logging
-import psycopg2
+import socket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 log_main = None
 log_db_dump = None
 log_s3 = None
 
+PIPE_BUFFER_SIZE = 1 << 20
+# fcntl.F_SETPIPE_SZ is only defined from python 3.10, but the value is the same on every Linux
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+CONNECTION_CHECK_TIMEOUT = 2
+ABORT_CHECK_INTERVAL = 1
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 32 * 1024 * 1024
+# S3's limits on a multipart upload
+MIN_MULTIPART_CHUNKSIZE = 5 * 1024 * 1024
+MAX_MULTIPART_CHUNKSIZE = 5 * 1024 * 1024 * 1024
+MAX_MULTIPART_PARTS = 10000
+# the streamed upload may buffer up to 1/UPLOAD_MEMORY_FRACTION of the ram
+UPLOAD_MEMORY_FRACTION = 32
+MIN_UPLOAD_CONCURRENCY = 8
+MAX_UPLOAD_CONCURRENCY = 256
+
+
+def log_stderr(command, stderr):
+    # only the exit status decides failure, pg_dump warns on stderr (e.g. about circular foreign-key
+    # constraints) and still exits 0 with a complete dump
+    if stderr:
+        log_db_dump.warning("'{}' succeeded with the following output: {}".format(
+            command[0], stderr.decode(errors='replace').strip()))
+
+
+def set_pipe_size(fd, size=PIPE_BUFFER_SIZE):
+    # Linux pipes only hold 64KiB by default, a bigger one lets both ends move the dump in fewer, larger reads and writes
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        # unprivileged users cannot go past /proc/sys/fs/pipe-max-size, keep the default then
+        pass
+
+
+def run_pipeline(commands, stdout, env=None, abort_check=None):
+    # each command's stdout feeds the next command's stdin, and env is only given to the first command.
+    # abort_check is called every ABORT_CHECK_INTERVAL seconds while the commands run, and stops them by raising
+    with contextlib.ExitStack() as stack:
+        processes = []
+        try:
+            for i, command in enumerate(commands):
+                is_last = i == len(commands) - 1
+                stdin = processes[-1][0].stdout if processes else None
+                # stderr goes to temp files so no process can block on a full stderr pipe while another is drained
+                err = stack.enter_context(tempfile.TemporaryFile())
+                process = subprocess.Popen(command,
+                                           env=env if stdin is None else None,
+                                           stdin=stdin,
+                                           stdout=stdout if is_last else subprocess.PIPE,
+                                           stderr=err)
+                if not is_last:
+                    set_pipe_size(process.stdout.fileno())
+                if stdin is not None:
+                    # the next process must hold the only read end, so the previous one gets SIGPIPE if it dies
+                    stdin.close()
+                processes.append((process, err))
+            for process, _ in processes:
+                while True:
+                    try:
+                        process.wait(timeout=ABORT_CHECK_INTERVAL if abort_check is not None else None)
+                        break
+                    except subprocess.TimeoutExpired:
+                        abort_check()
+        except Exception:
+            for process, _ in processes:
+                if process.stdout is not None:
+                    process.stdout.close()
+                process.kill()
+                process.wait()
+            raise
 
-def run_command(command):
-    out = subprocess.run(command,
-                          shell=True,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE,
-                          check=True)
-    out.check_returncode()
-    check_state(out.stderr is None or len(out.stderr) == 0, "The following error occurred: {}", out.stderr)
-    return out
+        for process, err in processes:
+            err.seek(0)
+            stderr = err.read()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+            log_stderr(process.args, stderr)
 
 
 def check_state(expression, formatted_message, *args):
@@ -30,99 +113,247 @@ def check_state(expression, formatted_message, *args):
         raise Exception(formatted_message.format(*args))
 
 
+def generate_timestamp():
+    return datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S_UTC")
+
+
+def get_total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        # os.sysconf does not exist or know these names on every platform
+        return None
+
+
 def check_file(filename):
-    check_state(os.path.exists(filename), "The path '{}' does not exist", filename)
-    check_state(os.path.isfile(filename), "The path '{}' is not a file", filename)
+    # a single stat answers both questions
+    try:
+        st = os.stat(filename)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Exception("The path '{}' does not exist".format(filename))
+    check_state(stat.S_ISREG(st.st_mode), "The path '{}' is not a file", filename)
 
 
 class DB_Dump(object):
 
-    def __init__(self, user, password, output_dir="/tmp", host="localhost", port="5432", dump_filename_prefix="postgres_backup"):
+    # custom is pg_dump's own compressed archive format (restorable with pg_restore),
+    # plain is a sql script piped through an external compressor
+    DUMP_FORMAT_SUFFIXES = {'custom': 'dump', 'plain': 'sql.gz'}
+    # a parallel dump is a pg_dump directory format dump packed into an uncompressed tar
+    PARALLEL_DUMP_SUFFIX = 'tar'
+
+    def __init__(self, user, password, output_dir="/tmp", host="localhost", port="5432", dump_filename_prefix="postgres_backup",
+                 compression_level=1, compression_threads=None, dump_format="custom", parallel_jobs=1):
+        check_state(dump_format in DB_Dump.DUMP_FORMAT_SUFFIXES, "The dump format '{}' is not one of: {}",
+                    dump_format, ", ".join(sorted(DB_Dump.DUMP_FORMAT_SUFFIXES)))
+        check_state(parallel_jobs >= 1, "The parallel_jobs must be at least 1, but was {}", parallel_jobs)
+        check_state(parallel_jobs <= 1 or dump_format == 'custom',
+                    "Parallel dumps (parallel_jobs={}) do not support dump_format = {}", parallel_jobs, dump_format)
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.output_dir = output_dir
         self.dump_filename_prefix = dump_filename_prefix
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads if compression_threads is not None else os.cpu_count()
+        # pigz is a drop-in parallel gzip, so fall back to gzip when it is not installed
+        self.compressor = shutil.which("pigz")
+        self.dump_format = dump_format
+        self.parallel_jobs = parallel_jobs
+        # fixed for the whole run, so every log line and filename of this backup agrees
+        self.timestamp = generate_timestamp()
 
     def _check_connection(self, dbname):
+        # only a tcp handshake, pg_dump itself fails fast on bad credentials or a missing database
         log_db_dump.info("Checking database connection...")
         try:
-            conn = psycopg2.connect(dbname=dbname, user=self.user,
-                                    host=self.host, port=self.port, password=self.password)
-            conn.close()
-        except Exception as e:
+            if self.host.startswith("/"):
+                # like libpq, a host starting with a slash is the directory of the server's unix socket
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(CONNECTION_CHECK_TIMEOUT)
+                with sock:
+                    sock.connect(os.path.join(self.host, ".s.PGSQL.{}".format(self.port)))
+            else:
+                socket.create_connection((self.host, int(self.port)), timeout=CONNECTION_CHECK_TIMEOUT).close()
+        except OSError as e:
             msg = "Unable to connect to postgres for host={}, dbname={} and user={} for Reason: {}".format(
                 self.host, dbname, self.user, e)
             log_db_dump.error(msg)
             raise
 
-
     @classmethod
     def _prepare_output_file(cls, output_file):
         parent_dir = os.path.dirname(output_file)
-        if os.path.exists(parent_dir):
-            if not os.path.isdir(parent_dir):
-                raise Exception("A non-directory already has the name '{}'".format(parent_dir))
-        else:
+        try:
+            st = os.stat(parent_dir)
+        except FileNotFoundError:
             os.makedirs(parent_dir)
+            return
+        check_state(stat.S_ISDIR(st.st_mode), "A non-directory already has the name '{}'", parent_dir)
 
-    @classmethod
-    def __generate_timestamp(cls):
-        t = datetime.datetime.utcnow()
-        return "{}{:02d}{:02d}_{:02d}{:02d}{:02d}_{}".format(t.year, t.month, t.day, t.hour, t.minute, t.second, 'UTC')
+    def generate_filename(self):
+        if self.parallel_jobs > 1:
+            suffix = DB_Dump.PARALLEL_DUMP_SUFFIX
+        else:
+            suffix = DB_Dump.DUMP_FORMAT_SUFFIXES[self.dump_format]
+        return "{}.{}.{}".format(self.dump_filename_prefix, self.timestamp, suffix)
+
+    def dump_db(self, dbname, output_file=None, output_fd=None, abort_check=None):
+        # with output_fd the dump is written to that file descriptor (e.g. the write end of a pipe)
+        # instead of a file, and the descriptor is closed once the dump has finished.
+        # abort_check is polled while pg_dump runs and stops the dump by raising, e.g. when the
+        # reader of output_fd failed but a parallel dump is not writing to it yet
+        check_state(output_file is None or output_fd is None, "Only one of output_file and output_fd can be given")
+        if output_fd is not None:
+            with os.fdopen(output_fd, "wb", PIPE_BUFFER_SIZE) as out:
+                self._check_connection(dbname)
+                self._write_dump(dbname, out, abort_check)
+            return None
 
-    def dump_db(self, dbname, output_file=None):
         if output_file is None:
-            output_file = "{}{}{}.{}.sql.gz".format(
-                self.output_dir, os.sep, self.dump_filename_prefix, DB_Dump.__generate_timestamp())
+            output_file = "{}{}{}".format(self.output_dir, os.sep, self.generate_filename())
 
         self._prepare_output_file(output_file)
-        dump_cmd = "PGPASSWORD={} pg_dump -h {}  -p {} -U {} {}".format(
-            self.password, self.host, self.port, self.user, dbname)
-        compress_cmd = "gzip > {}".format(output_file)
         self._check_connection(dbname)
-        process_output = run_command(dump_cmd+" | "+compress_cmd)
+        if self.parallel_jobs <= 1 and self.dump_format == 'custom':
+            # unlike a streamed archive, writing to a regular file lets pg_dump record data offsets for pg_restore -j
+            run_pipeline([self._pg_dump_cmd(dbname, "-Fc", "-Z", str(self.compression_level), "-f", output_file)],
+                         subprocess.DEVNULL, env=self._pg_env(), abort_check=abort_check)
+        else:
+            with open(output_file, "wb", PIPE_BUFFER_SIZE) as out:
+                self._write_dump(dbname, out, abort_check)
         check_file(output_file)
         return output_file
 
+    def _write_dump(self, dbname, out, abort_check=None):
+        if self.parallel_jobs > 1:
+            self._dump_parallel(dbname, out, abort_check)
+        else:
+            run_pipeline(self._dump_cmds(dbname), out, env=self._pg_env(), abort_check=abort_check)
+
+    def _dump_parallel(self, dbname, out, abort_check=None):
+        # pg_dump can only dump tables in parallel into a directory, which is staged under output_dir
+        # and then streamed into out as a tar without writing the tar itself to disk
+        os.makedirs(self.output_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix="{}.".format(self.dump_filename_prefix), dir=self.output_dir)
+        try:
+            dump_dir = os.path.join(staging_dir, "{}.{}".format(self.dump_filename_prefix, self.timestamp))
+            log_db_dump.info("Dumping '{}' with {} parallel jobs into '{}'...".format(dbname, self.parallel_jobs, dump_dir))
+            # nothing is written to out until the whole directory is dumped, so only abort_check can stop it early
+            if abort_check is not None:
+                abort_check()
+            run_pipeline([self._pg_dump_cmd(dbname, "-Fd", "-j", str(self.parallel_jobs), "-Z", str(self.compression_level),
+                                            "-f", dump_dir)],
+                         subprocess.DEVNULL, env=self._pg_env(), abort_check=abort_check)
+            # the table files are already compressed by pg_dump, so the tar is not compressed again
+            with tarfile.open(fileobj=out, mode="w|") as tar:
+                tar.add(dump_dir, arcname=os.path.basename(dump_dir))
+            # closing out first lets its reader finish (e.g. the upload) while the staging directory is removed
+            out.close()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _dump_cmds(self, dbname):
+        if self.dump_format == 'custom':
+            return [self._pg_dump_cmd(dbname, "-Fc", "-Z", str(self.compression_level))]
+        return [self._pg_dump_cmd(dbname), self._compress_cmd()]
+
+    def _pg_env(self):
+        # the password only ever lives in pg_dump's environment, never in an argv visible in /proc/*/cmdline
+        env = dict(os.environ)
+        if self.password is not None:
+            env['PGPASSWORD'] = self.password
+        return env
+
+    def _pg_dump_cmd(self, dbname, *options):
+        return ["pg_dump", "-h", self.host, "-p", self.port, "-U", self.user] + list(options) + [dbname]
+
+    def _compress_cmd(self):
+        if self.compressor is not None:
+            return [self.compressor, "-p", str(self.compression_threads), "-{}".format(self.compression_level)]
+        return ["gzip", "-{}".format(self.compression_level)]
+
 
 class S3Client:
+    ADDRESSING_STYLES = ('auto', 'path', 'virtual')
+
     def __init__(self, endpoint_url, access_key, secret_key,
-                 data_bucket):
+                 data_bucket, max_attempts=10, use_accelerate=False, addressing_style=None,
+                 multipart_chunksize=MULTIPART_CHUNKSIZE):
+        # S3 compatible servers like MinIO usually only understand path style bucket addressing
+        if addressing_style is None:
+            addressing_style = 'path' if endpoint_url is not None else 'virtual'
+        check_state(addressing_style in S3Client.ADDRESSING_STYLES, "The addressing style '{}' is not one of: {}",
+                    addressing_style, ", ".join(S3Client.ADDRESSING_STYLES))
+        check_state(not use_accelerate or (endpoint_url is None and addressing_style != 'path'),
+                    "S3 transfer acceleration needs the default AWS endpoint and virtual host style addressing")
+        check_state(MIN_MULTIPART_CHUNKSIZE <= multipart_chunksize <= MAX_MULTIPART_CHUNKSIZE,
+                    "The multipart chunksize must be between 5MiB and 5GiB, but was {} bytes", multipart_chunksize)
         self.endpoint_url = endpoint_url
+        self.max_attempts = max_attempts
+        self.use_accelerate = use_accelerate
+        self.addressing_style = addressing_style
+        self.multipart_chunksize = multipart_chunksize
         self.__access_key = access_key
         self.__secret_key = secret_key
         self.data_bucket = data_bucket
+        self.__transfer_config = S3Client.__create_transfer_config(multipart_chunksize)
+        log_s3.info("Uploading in {} MiB parts, so a streamed backup can be at most {:.0f} GiB".format(
+            multipart_chunksize >> 20, MAX_MULTIPART_PARTS * multipart_chunksize / (1 << 30)))
 
         # state
         self.__client = self.__connect()
-        self.__buckets = S3Client.__get_bucket_names(self.__client)
+        # names of buckets known to exist, filled in on demand
+        self.__buckets = set()
+
+    @classmethod
+    def __create_transfer_config(cls, multipart_chunksize):
+        # the upload is network bound, so upload many multipart parts at once. A streamed upload buffers
+        # every part it has read in memory, so it holds at most about max_concurrency * multipart_chunksize
+        # bytes, which is kept to 1/UPLOAD_MEMORY_FRACTION of the ram (but at least MIN_UPLOAD_CONCURRENCY parts)
+        total_memory = get_total_memory()
+        if total_memory is None:
+            max_concurrency = MIN_UPLOAD_CONCURRENCY
+        else:
+            max_concurrency = total_memory // (UPLOAD_MEMORY_FRACTION * multipart_chunksize)
+        max_concurrency = max(MIN_UPLOAD_CONCURRENCY, min(MAX_UPLOAD_CONCURRENCY, max_concurrency))
+        transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                         multipart_chunksize=multipart_chunksize,
+                                         max_concurrency=max_concurrency,
+                                         max_io_queue=max_concurrency * 2,
+                                         use_threads=True)
+        # upload_fileobj only reads this many parts ahead of a non-seekable stream like the dump pipe,
+        # and the default of 10 would cap the parts in flight no matter what max_concurrency says
+        transfer_config.max_in_memory_upload_chunks = max_concurrency
+        return transfer_config
 
     def __connect(self):
         log_s3.debug("Connecting to S3 client...")
+        # botocore only pools 10 connections by default, which would serialize uploads with more parts in flight
+        config = Config(max_pool_connections=self.__transfer_config.max_concurrency,
+                        retries={'max_attempts': self.max_attempts, 'mode': 'adaptive'},
+                        tcp_keepalive=True,
+                        s3={'addressing_style': self.addressing_style,
+                            'use_accelerate_endpoint': self.use_accelerate})
         return boto3.client('s3',
                             aws_access_key_id=self.__access_key,
                             aws_secret_access_key=self.__secret_key,
                             use_ssl=False,
-                            endpoint_url=self.endpoint_url)
+                            endpoint_url=self.endpoint_url,
+                            config=config)
 
     @classmethod
     def __get_bucket_names(cls, client):
         log_s3.debug("Retrieving list of all buckets...")
-        out = []
-        for entry in client.list_buckets()['Buckets']:
-            out.append(entry['Name'])
-        return out
+        # newer S3 apis page through the buckets, older ones return them all in one response
+        if client.can_paginate('list_buckets'):
+            return [entry['Name'] for page in client.get_paginator('list_buckets').paginate() for entry in page['Buckets']]
+        return [entry['Name'] for entry in client.list_buckets()['Buckets']]
 
     def setup(self):
         self.setup_data_bucket()
 
-    @classmethod
-    def __generate_timestamp(cls):
-        t = datetime.datetime.utcnow()
-        return "{}{:02d}{:02d}_{:02d}{:02d}{:02d}_{}".format(t.year, t.month, t.day, t.hour, t.minute, t.second, 'UTC')
-
     def __generate_key(self, base_filename):
         return "{}/{}".format(self.data_bucket, base_filename)
 
@@ -133,7 +364,17 @@ class S3Client:
         key = base_filename # self.__generate_key(base_filename)
         self.__client.upload_file(local_filename,
                                   self.data_bucket,
-                                  key)
+                                  key,
+                                  Config=self.__transfer_config)
+
+    def upload_stream(self, fileobj, key):
+        self.__client.upload_fileobj(fileobj,
+                                     self.data_bucket,
+                                     key,
+                                     Config=self.__transfer_config)
+
+    def remove(self, key):
+        self.__client.delete_object(Bucket=self.data_bucket, Key=key)
 
     def check_bucket_existence(self):
         check_state(self.is_bucket_exists(self.data_bucket), "The bucket '{}' does not exist", self.data_bucket)
@@ -145,9 +386,25 @@ class S3Client:
         if not self.is_bucket_exists(name):
             log_s3.warning("The bucket '{}' does not exist. Creating it ...".format(name))
             self.__client.create_bucket(Bucket=name)
+            self.__buckets.add(name)
 
     def is_bucket_exists(self, name):
-        return name in self.__buckets
+        if name in self.__buckets:
+            return True
+        try:
+            self.__client.head_bucket(Bucket=name)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('404', 'NoSuchBucket'):
+                return False
+            if code != '403':
+                raise
+            # some policies deny HeadBucket but still allow listing the buckets we own
+            log_s3.debug("Not allowed to head bucket '{}', falling back to listing buckets".format(name))
+            self.__buckets.update(S3Client.__get_bucket_names(self.__client))
+            return name in self.__buckets
+        self.__buckets.add(name)
+        return True
 
 def setup_logfile(logfile):
     parent_dir = os.path.dirname(logfile)
@@ -202,23 +459,72 @@ def main():
     s3_data_bucket = cfg['s3_data_bucket']
     s3_access_key = cfg['s3_access_key'] if config.has_option(None, 's3_access_key') else None
     s3_secret_key = cfg['s3_secret_key'] if config.has_option(None, 's3_secret_key') else None
+    s3_max_attempts = int(cfg['s3_max_attempts']) if config.has_option(None, 's3_max_attempts') else 10
+    s3_use_accelerate = config.getboolean(configparser.DEFAULTSECT, 's3_use_accelerate') if config.has_option(None, 's3_use_accelerate') else False
+    s3_addressing_style = cfg['s3_addressing_style'] if config.has_option(None, 's3_addressing_style') else None
+    # in MiB
+    s3_multipart_chunksize = int(cfg['s3_multipart_chunksize']) if config.has_option(None, 's3_multipart_chunksize') else MULTIPART_CHUNKSIZE >> 20
     backup_file_prefix = cfg['backup_file_prefix']
     backup_output_dir = cfg['backup_output_dir']
-    dumper = DB_Dump(db_user, db_password, host=db_host, port=db_port, dump_filename_prefix=backup_file_prefix, output_dir=backup_output_dir)
-    log_main.info("Dumping '{}' postgres database...".format(db_name))
-    output_filename = dumper.dump_db(db_name)
-    log_main.info("\t- successfully dumped to file '{}'".format(output_filename))
-
-    client = S3Client(s3_endpoint_url, s3_access_key, s3_secret_key, s3_data_bucket)
-    log_main.info("Setting up buckets...")
-    client.setup()
-    log_main.info("Uploading file '{}' to s3 at endpoint '{}'...".format(output_filename, s3_endpoint_url))
-    client.upload(output_filename)
-    log_main.info("\t- successfully uploaded file '{}' to bucket '{}'".format(output_filename, s3_data_bucket))
-
-    if os.path.exists(output_filename):
-        os.remove(output_filename)
-        log_main.info("Removed file '{}'".format(output_filename))
+    compression_level = int(cfg['compression_level']) if config.has_option(None, 'compression_level') else 1
+    compression_threads = int(cfg['compression_threads']) if config.has_option(None, 'compression_threads') else None
+    dump_format = cfg['dump_format'] if config.has_option(None, 'dump_format') else 'custom'
+    parallel_jobs = int(cfg['parallel_jobs']) if config.has_option(None, 'parallel_jobs') else 1
+    check_state(1 <= compression_level <= 9, "The compression_level must be between 1 and 9, but was {}", compression_level)
+    check_state(s3_max_attempts >= 0, "The s3_max_attempts must be at least 0, but was {}", s3_max_attempts)
+    dumper = DB_Dump(db_user, db_password, host=db_host, port=db_port, dump_filename_prefix=backup_file_prefix, output_dir=backup_output_dir,
+                     compression_level=compression_level, compression_threads=compression_threads, dump_format=dump_format,
+                     parallel_jobs=parallel_jobs)
+
+    def connect_s3():
+        client = S3Client(s3_endpoint_url, s3_access_key, s3_secret_key, s3_data_bucket, max_attempts=s3_max_attempts,
+                          use_accelerate=s3_use_accelerate, addressing_style=s3_addressing_style,
+                          multipart_chunksize=s3_multipart_chunksize << 20)
+        log_main.info("Setting up buckets...")
+        client.setup()
+        return client
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="s3") as pool:
+        # connecting to S3 and setting up the bucket runs while pg_dump starts filling the pipe
+        client_future = pool.submit(connect_s3)
+
+        key = dumper.generate_filename()
+        log_main.info("Streaming '{}' postgres database to '{}' in bucket '{}' at endpoint '{}'...".format(
+            db_name, key, s3_data_bucket, s3_endpoint_url))
+        # pg_dump writes into the pipe while a worker thread uploads from it, so the dump and the upload overlap
+        read_fd, write_fd = os.pipe()
+        set_pipe_size(write_fd)
+
+        def upload():
+            # closing the read end on any failure makes pg_dump fail on its next write, which stops the dump
+            with os.fdopen(read_fd, 'rb', PIPE_BUFFER_SIZE) as stream:
+                client_future.result().upload_stream(stream, key)
+
+        upload_future = pool.submit(upload)
+
+        def check_upload():
+            # the upload can only end before the dump closes the pipe by failing, e.g. when S3 could not be set up
+            if upload_future.done():
+                upload_future.result()
+
+        try:
+            dumper.dump_db(db_name, output_fd=write_fd, abort_check=check_upload)
+            upload_future.result()
+        except Exception as e:
+            upload_error = upload_future.exception()
+            if client_future.exception() is None:
+                # the upload completes at EOF even if pg_dump died part way, so never leave a truncated backup behind
+                log_main.error("Backup failed, removing '{}' from bucket '{}'".format(key, s3_data_bucket))
+                try:
+                    client_future.result().remove(key)
+                except Exception as remove_error:
+                    # keep raising the error that made the backup fail, not this one
+                    log_main.error("Unable to remove '{}' from bucket '{}', a partial backup may still be there. Reason: {}".format(
+                        key, s3_data_bucket, remove_error))
+            if upload_error is not None and upload_error is not e:
+                raise upload_error from e
+            raise
+        log_main.info("\t- successfully uploaded '{}' to bucket '{}'".format(key, s3_data_bucket))
 
 
 if __name__ == '__main__':